@@ -1,12 +1,25 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, send_file
 from flask_cors import CORS
+import orjson
 import recipe_scrapers
 import logging
 import time
 import os
+import hashlib
+import sqlite3
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from io import BytesIO
 from PIL import Image
+from cachetools import TTLCache
+from transcode import transcode
+import diskcache
 from dotenv import load_dotenv
 
 # Carica variabili da .env
@@ -34,21 +47,112 @@ if not API_KEY:
 
 logging.info("SCRAPER_API_KEY configurata — autenticazione abilitata")
 
+# Sessione HTTP condivisa per il proxy immagini: riusa le connessioni
+# (keep-alive) verso gli stessi CDN invece di rifare TCP+TLS ogni volta
+_http = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=200,
+    max_retries=Retry(total=2, backoff_factor=0.2),
+)
+_http.mount("https://", _adapter)
+_http.mount("http://", _adapter)
+
+# Cache dei risultati di /scrape per URL (1 ora): evita di riscaricare e
+# riparsare la stessa pagina. TTLCache non è thread-safe, serve il lock
+_scrape_cache = TTLCache(maxsize=10_000, ttl=3600)
+_scrape_cache_lock = threading.Lock()
+
+# Pool di processi per la conversione delle immagini (CPU-bound, evita il GIL).
+# Ogni worker gunicorn ha il suo pool di IMAGE_POOL_WORKERS processi (default 1):
+# con un worker per CPU (default di gunicorn.conf.py) è circa un processo per CPU.
+# "forkserver" perché fare fork di un worker gunicorn multi-thread non è sicuro;
+# i processi vengono avviati solo alla prima conversione
+_image_pool_size = max(1, int(os.environ.get("IMAGE_POOL_WORKERS") or 1))
+
+
+def _new_image_pool():
+    return ProcessPoolExecutor(
+        max_workers=_image_pool_size,
+        mp_context=multiprocessing.get_context("forkserver"),
+    )
+
+
+_image_pool = _new_image_pool()
+_image_pool_lock = threading.Lock()
+
+
+def _reset_image_pool(broken_pool):
+    """Sostituisce il pool se un processo è morto (es. OOM killer su un'immagine enorme)"""
+    global _image_pool
+    with _image_pool_lock:
+        # Più thread possono accorgersene insieme: lo ricrea solo il primo
+        if _image_pool is broken_pool:
+            logging.warning("Pool di conversione immagini interrotto, lo ricreo")
+            _image_pool = _new_image_pool()
+            broken_pool.shutdown(wait=False)
+
+# Cache su disco (LRU, max 5 GB) delle immagini già convertite, per URL.
+# La cartella deve essere privata del servizio: mai una cartella condivisa come
+# /tmp, dove un altro utente potrebbe preparare un database della cache malevolo.
+# La cache è opzionale: se la cartella non è utilizzabile il servizio funziona senza
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "/var/cache/recipe-imgs")
+
+try:
+    os.makedirs(IMAGE_CACHE_DIR, mode=0o700, exist_ok=True)
+    _image_cache = diskcache.Cache(
+        IMAGE_CACHE_DIR,
+        size_limit=5 * 1024**3,
+        eviction_policy="least-recently-used",
+    )
+except (OSError, sqlite3.Error) as e:
+    logging.error(f"Cache immagini non utilizzabile in {IMAGE_CACHE_DIR}: {e}")
+    logging.error("/image-proxy funziona senza cache: crea la cartella per l'utente del servizio o imposta IMAGE_CACHE_DIR nel file .env")
+    _image_cache = None
+
+def _json(data, status=200):
+    """Serializza la risposta con orjson (più veloce del json standard di jsonify)"""
+    return Response(orjson.dumps(data), status=status, mimetype="application/json")
+
+
 @app.before_request
 def require_api_key():
     # Permetti richieste OPTIONS (CORS preflight) senza autenticazione
     if request.method == "OPTIONS":
         return None
     
-    if request.path == "/scrape":
+    if request.path in ("/scrape", "/scrape-batch"):
         key = request.headers.get("X-API-Key")
         if key != API_KEY:
             logging.warning(f"Tentativo di accesso non autorizzato da {request.remote_addr}")
-            return jsonify({"error": "Unauthorized"}), 403
+            return _json({"error": "Unauthorized"}, 403)
 
 
 import re
 
+# Unità di misura comuni (italiano e inglese)
+_UNITS = r'cups?|tablespoons?|tbsps?|teaspoons?|tsps?|grams?|g|kg|mg|ml|l|cl|dl|oz|lbs?|pounds?|' \
+         r'tazz[ae]|cucchiai[oi]?|cucchiaini?|pizzic[oi]|q\.?b\.?|pezz[oi]|fett[ae]|' \
+         r'spicchi[oi]?|foglie?|ramett[oi]?|manciata|manciate|mazzo|mazzi|unità|unitá|pz\.?|n\.?|' \
+         r'cloves?|pinches?|pieces?|slices?'
+
+# Quantità speciali senza numeri (q.b., pizzico, manciata, etc.)
+_SPECIAL_UNITS = r'q\.?b\.?|pizzic[oi]|manciata|manciate|mazzo|mazzi'
+
+# Pattern compilati una sola volta all'avvio, non ad ogni ingrediente
+# Quantità alla FINE (es. "flour 200 g")
+_Q_END_RE = re.compile(rf'^(.+?)\s+([0-9\/\-.,]+\s*(?:{_UNITS}))$', re.IGNORECASE)
+# Quantità speciali alla FINE (es. "sale q.b.")
+_SPECIAL_END_RE = re.compile(rf'^(.+?)\s+({_SPECIAL_UNITS})$', re.IGNORECASE)
+# Quantità speciali all'INIZIO (es. "q.b. sale", "qb sale")
+_SPECIAL_START_RE = re.compile(rf'^({_UNITS})\s+(?:di\s+)?(.+)$', re.IGNORECASE)
+# Quantità all'INIZIO (es. "2 cups flour")
+_Q_START_RE = re.compile(rf'^([0-9\/\-.,]+\s*(?:{_UNITS})?)\s+(?:di\s+)?(.+)$', re.IGNORECASE)
+
+# Nessuna unità di misura inizia con una cifra
+_DIGITS = frozenset('0123456789')
+
+
 def parse_ingredient(ingredient_text):
     """
     Separa la quantità dal nome dell'ingrediente.
@@ -64,22 +168,8 @@ def parse_ingredient(ingredient_text):
     if not text:
         return {"quantity": "", "name": ""}
     
-    # Unità di misura comuni (italiano e inglese)
-    units = r'cups?|tablespoons?|tbsps?|teaspoons?|tsps?|grams?|g|kg|mg|ml|l|cl|dl|oz|lbs?|pounds?|' \
-            r'tazz[ae]|cucchiai[oi]?|cucchiaini?|pizzic[oi]|q\.?b\.?|pezz[oi]|fett[ae]|' \
-            r'spicchi[oi]?|foglie?|ramett[oi]?|manciata|manciate|mazzo|mazzi|unità|unitá|pz\.?|n\.?|' \
-            r'cloves?|pinches?|pieces?|slices?'
-    
-    # Quantità speciali senza numeri (q.b., pizzico, manciata, etc.)
-    special_units = r'q\.?b\.?|pizzic[oi]|manciata|manciate|mazzo|mazzi'
-    
     # Prova prima a cercare la quantità alla FINE (es. "flour 200 g")
-    quantity_at_end = re.compile(
-        rf'^(.+?)\s+([0-9\/\-.,]+\s*(?:{units}))$',
-        re.IGNORECASE
-    )
-    
-    match_end = quantity_at_end.match(text)
+    match_end = _Q_END_RE.match(text)
     if match_end:
         name = match_end.group(1).strip()
         quantity = match_end.group(2).strip()
@@ -87,38 +177,25 @@ def parse_ingredient(ingredient_text):
             return {"quantity": quantity, "name": name}
     
     # Cerca quantità speciali alla FINE (es. "sale q.b.")
-    special_at_end = re.compile(
-        rf'^(.+?)\s+({special_units})$',
-        re.IGNORECASE
-    )
-    
-    match_special_end = special_at_end.match(text)
+    match_special_end = _SPECIAL_END_RE.match(text)
     if match_special_end:
         name = match_special_end.group(1).strip()
         quantity = match_special_end.group(2).strip()
         if name and len(name) > 2:
             return {"quantity": quantity, "name": name}
     
-    # Cerca quantità speciali all'INIZIO (es. "q.b. sale", "qb sale")
-    special_quantity = re.compile(
-        rf'^({units})\s+(?:di\s+)?(.+)$',
-        re.IGNORECASE
-    )
-    
-    match_special = special_quantity.match(text)
-    if match_special:
-        quantity = match_special.group(1).strip()
-        name = match_special.group(2).strip()
-        if name and len(name) > 2:
-            return {"quantity": quantity, "name": name}
+    # Cerca quantità speciali all'INIZIO (es. "q.b. sale", "qb sale"):
+    # inutile se il testo inizia con una cifra, caso più comune ("2 cups flour")
+    if text[0] not in _DIGITS:
+        match_special = _SPECIAL_START_RE.match(text)
+        if match_special:
+            quantity = match_special.group(1).strip()
+            name = match_special.group(2).strip()
+            if name and len(name) > 2:
+                return {"quantity": quantity, "name": name}
     
     # Altrimenti cerca la quantità all'INIZIO (es. "2 cups flour")
-    quantity_at_start = re.compile(
-        rf'^([0-9\/\-.,]+\s*(?:{units})?)\s+(?:di\s+)?(.+)$',
-        re.IGNORECASE
-    )
-    
-    match_start = quantity_at_start.match(text)
+    match_start = _Q_START_RE.match(text)
     if match_start:
         quantity = match_start.group(1).strip()
         name = match_start.group(2).strip()
@@ -141,25 +218,98 @@ def format_yields(yields_value):
     
     text = str(yields_value).strip()
     
-    # Estrai il numero usando regex
-    number_match = re.search(r'(\d+)', text)
-    if number_match:
-        return number_match.group(1)
+    # Cerca la prima sequenza di cifre (isdecimal equivale a \d delle regex)
+    n = len(text)
+    start = 0
+    while start < n and not text[start].isdecimal():
+        start += 1
     
     # Se non trova un numero, ritorna N/A
-    return "N/A"
+    if start == n:
+        return "N/A"
+    
+    end = start + 1
+    while end < n and text[end].isdecimal():
+        end += 1
+    return text[start:end]
+
+
+# Campi letti dallo scraper e restituiti da /scrape
+_SCRAPER_FIELDS = (
+    "title", "cook_time", "prep_time", "total_time", "yields", "ingredients",
+    "instructions", "author", "category", "cuisine", "description", "image",
+)
+
+# Eccezioni "attese" quando un sito non espone un campo
+_SAFE_EXC = (NotImplementedError, AttributeError, recipe_scrapers._exceptions.SchemaOrgException)
 
 
-def safe_call(method):
+def safe_call(scraper, name):
+    method = getattr(scraper, name, None)
+    if method is None:
+        return "N/A"
     try:
         return method()
-    except (NotImplementedError, AttributeError, recipe_scrapers._exceptions.SchemaOrgException):
+    except _SAFE_EXC:
         return "N/A"
     except Exception as e:
         logging.error(f"Errore in safe_call: {e}")
         return "N/A"
 
 
+# Ultimo timestamp formattato: [secondo, stringa]. Senza lock: con richieste
+# concorrenti a cavallo di un secondo la stringa può essere indietro di 1 s
+_ts_cache = [0, ""]
+
+
+def _fetched_at():
+    """Ora locale ISO 8601, formattata al massimo una volta al secondo"""
+    now = int(time.time())
+    if _ts_cache[0] != now:
+        _ts_cache[1] = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(now))
+        _ts_cache[0] = now
+    return _ts_cache[1]
+
+
+def _scrape_one(url, use_cache=True):
+    """
+    Scraping di una ricetta, con cache per URL.
+    Solleva l'eccezione di recipe_scrapers se la pagina non è leggibile.
+    """
+    if use_cache:
+        with _scrape_cache_lock:
+            cached = _scrape_cache.get(url)
+        if cached is not None:
+            logging.info(f"Cache hit: {url}")
+            return cached
+
+    logging.info(f"Scraping: {url}")
+    scraper = recipe_scrapers.scrape_me(url)
+
+    data = {name: safe_call(scraper, name) for name in _SCRAPER_FIELDS}
+    data["yields"] = format_yields(data["yields"])
+    
+    # Parsa gli ingredienti
+    raw_ingredients = data["ingredients"]
+    if isinstance(raw_ingredients, list):
+        data["ingredients"] = [parse_ingredient(ing) for ing in raw_ingredients]
+    else:
+        data["ingredients"] = []
+    
+    data["url"] = url
+    data["fetched_at"] = _fetched_at()
+
+    with _scrape_cache_lock:
+        _scrape_cache[url] = data
+
+    return data
+
+
+def _use_scrape_cache():
+    # "Cache-Control: no-cache" forza un nuovo scraping
+    return "no-cache" not in request.headers.get("Cache-Control", "")
+
+
 # ==========================
 # ENDPOINT PRINCIPALE
 # ==========================
@@ -167,98 +317,155 @@ def safe_call(method):
 def scrape_recipe():
     url = request.args.get("url")
     if not url:
-        return jsonify({"error": "Missing URL parameter"}), 400
+        return _json({"error": "Missing URL parameter"}, 400)
 
-    logging.info(f"Scraping: {url}")
     try:
-        scraper = recipe_scrapers.scrape_me(url)
+        data = _scrape_one(url, _use_scrape_cache())
     except Exception as e:
         logging.error(f"Errore iniziale di scraping: {e}")
-        return jsonify({"error": str(e), "url": url}), 500
+        return _json({"error": str(e), "url": url}, 500)
 
-    image_url = safe_call(getattr(scraper, "image", lambda: "N/A"))
-    
-    # Ottieni gli ingredienti e parsali
-    raw_ingredients = safe_call(getattr(scraper, "ingredients", lambda: "N/A"))
-    parsed_ingredients = []
-    
-    if raw_ingredients != "N/A" and isinstance(raw_ingredients, list):
-        for ing in raw_ingredients:
-            parsed_ingredients.append(parse_ingredient(ing))
-    
-    data = {
-        "title": safe_call(getattr(scraper, "title", lambda: "N/A")),
-        "cook_time": safe_call(getattr(scraper, "cook_time", lambda: "N/A")),
-        "prep_time": safe_call(getattr(scraper, "prep_time", lambda: "N/A")),
-        "total_time": safe_call(getattr(scraper, "total_time", lambda: "N/A")),
-        "yields": format_yields(safe_call(getattr(scraper, "yields", lambda: "N/A"))),
-        "ingredients": parsed_ingredients,
-        "instructions": safe_call(getattr(scraper, "instructions", lambda: "N/A")),
-        "url": url,
-        "fetched_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
-        "author": safe_call(getattr(scraper, "author", lambda: "N/A")),
-        "category": safe_call(getattr(scraper, "category", lambda: "N/A")),
-        "cuisine": safe_call(getattr(scraper, "cuisine", lambda: "N/A")),
-        "description": safe_call(getattr(scraper, "description", lambda: "N/A")),
-        "image": image_url,
-    }
-
-    return jsonify(data)
+    return _json(data)
+
+
+# Numero massimo di URL per richiesta a /scrape-batch
+MAX_BATCH_SIZE = 50
+
+
+@app.route("/scrape-batch", methods=["POST"])
+def scrape_batch():
+    """Scraping in parallelo di più ricette: body JSON {"urls": [...]}"""
+    body = request.get_json(silent=True)
+    urls = body.get("urls") if isinstance(body, dict) else None
+    if not isinstance(urls, list) or not urls or not all(isinstance(u, str) and u for u in urls):
+        return _json({"error": "Missing or invalid 'urls' list"}, 400)
+    if len(urls) > MAX_BATCH_SIZE:
+        return _json({"error": f"Too many URLs (max {MAX_BATCH_SIZE})"}, 400)
+
+    use_cache = _use_scrape_cache()
+
+    def scrape(url):
+        # Un URL non valido non deve far fallire l'intero batch
+        try:
+            return _scrape_one(url, use_cache)
+        except Exception as e:
+            logging.error(f"Errore iniziale di scraping: {e}")
+            return {"error": str(e), "url": url}
+
+    # Lo scraping è quasi tutto attesa di rete: i thread sovrappongono le richieste
+    with ThreadPoolExecutor(max_workers=min(32, len(urls))) as executor:
+        results = list(executor.map(scrape, urls))
+
+    return _json({"results": results})
 
 
 # ==========================
 # PROXY IMMAGINI
 # ==========================
+# Header fissi per il download delle immagini
+_IMG_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'image/avif,image/webp,image/apng,image/*,*/*;q=0.8',
+    'Accept-Language': 'it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7',
+}
+
+
+def _image_cache_get(key):
+    """Lettura dalla cache immagini: un errore (DB bloccato, file corrotto) vale come cache miss"""
+    if _image_cache is None:
+        return None
+    try:
+        return _image_cache.get(key)
+    except Exception as e:
+        logging.warning(f"Errore in lettura dalla cache immagini: {e}")
+        return None
+
+
+def _image_cache_set(key, jpeg):
+    """Scrittura nella cache immagini: un errore (disco pieno, DB bloccato) non fa fallire la risposta"""
+    if _image_cache is None:
+        return
+    try:
+        _image_cache.set(key, jpeg)
+    except Exception as e:
+        logging.warning(f"Errore in scrittura nella cache immagini: {e}")
+
+
+def _image_response(jpeg, etag):
+    """Risposta JPEG con ETag (304 se il browser ha già l'immagine) e cache lunga"""
+    response = send_file(
+        BytesIO(jpeg),
+        mimetype='image/jpeg',
+        download_name='image.jpg',
+        etag=etag,
+        conditional=True,
+        max_age=86400,
+    )
+    response.headers['Cache-Control'] = 'public, max-age=86400, immutable'
+    return response
+
+
 @app.route("/image-proxy", methods=["GET"])
 def image_proxy():
     """Proxy per scaricare e convertire immagini in formati compatibili"""
     url = request.args.get("url")
     if not url:
-        return jsonify({"error": "Missing URL parameter"}), 400
+        return _json({"error": "Missing URL parameter"}, 400)
     
+    optimize = request.args.get("optimize") == "1"
+    
+    # Lato massimo dell'immagine restituita
+    max_size = 1200
+
+    key = hashlib.sha1(f"{url}|{optimize}".encode()).hexdigest()
+
     try:
-        # Scarica l'immagine
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': 'image/avif,image/webp,image/apng,image/*,*/*;q=0.8',
-            'Accept-Language': 'it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7',
-            'Referer': url.rsplit('/', 1)[0] if '/' in url else url,
-        }
-        
-        response = requests.get(url, headers=headers, timeout=10, stream=True)
-        response.raise_for_status()
-        
-        # Converti in formato PNG o JPEG standard
-        img = Image.open(BytesIO(response.content))
-        
-        # Converti in RGB se necessario (per gestire PNG con trasparenza o altri formati)
-        if img.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-            img = background
-        elif img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # Ridimensiona se troppo grande (max 1200px)
-        max_size = 1200
-        if img.width > max_size or img.height > max_size:
-            img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-        
-        # Salva in JPEG
-        img_io = BytesIO()
-        img.save(img_io, 'JPEG', quality=85, optimize=True)
-        img_io.seek(0)
+        # Immagine già convertita: niente download né conversione
+        cached = _image_cache_get(key)
+        if cached is not None:
+            return _image_response(cached, key)
+
+        # Scarica l'immagine (solo il Referer dipende dall'URL)
+        headers = {**_IMG_HEADERS, 'Referer': url.rsplit('/', 1)[0] if '/' in url else url}
         
-        return send_file(img_io, mimetype='image/jpeg', download_name='image.jpg')
+        with _http.get(url, headers=headers, timeout=10, stream=True) as response:
+            response.raise_for_status()
+            data = response.content
+
+        # Image.open legge solo l'header: formato e dimensioni senza decodifica
+        img = Image.open(BytesIO(data))
+
+        # JPEG già compatibile e non troppo grande: restituisci i byte originali
+        if (img.format == 'JPEG' and img.mode in ('RGB', 'L')
+                and img.width <= max_size and img.height <= max_size):
+            jpeg = data
+        else:
+            # Decodifica/ridimensionamento/encode sono CPU-bound: fuori dal thread della richiesta
+            pool = _image_pool
+            try:
+                future = pool.submit(transcode, data, max_size, optimize)
+                jpeg = future.result(timeout=15)
+            except FutureTimeoutError:
+                # Se è ancora in coda non deve occupare il pool per un client che ha già
+                # ricevuto l'errore (una conversione già avviata invece termina comunque)
+                future.cancel()
+                logging.error(f"Timeout nella conversione dell'immagine: {url}")
+                return _json({"error": "Image conversion timed out"}, 504)
+            except BrokenProcessPool:
+                # Nessun nuovo tentativo: la stessa immagine potrebbe uccidere anche il nuovo pool
+                _reset_image_pool(pool)
+                logging.error(f"Conversione interrotta (processo terminato): {url}")
+                return _json({"error": "Image conversion temporarily unavailable"}, 503)
+
+        _image_cache_set(key, jpeg)
+        return _image_response(jpeg, key)
         
     except requests.RequestException as e:
         logging.error(f"Errore nel download dell'immagine: {e}")
-        return jsonify({"error": f"Failed to download image: {str(e)}"}), 500
+        return _json({"error": f"Failed to download image: {str(e)}"}, 500)
     except Exception as e:
         logging.error(f"Errore nella conversione dell'immagine: {e}")
-        return jsonify({"error": f"Failed to process image: {str(e)}"}), 500
+        return _json({"error": f"Failed to process image: {str(e)}"}, 500)
 
 
 # ==========================
@@ -266,11 +473,12 @@ def image_proxy():
 # ==========================
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"status": "ok", "service": "recipe-scraper"}), 200
+    return _json({"status": "ok", "service": "recipe-scraper"}, 200)
 
 
 # ==========================
 # ENTRYPOINT
 # ==========================
+# Solo per sviluppo locale: in produzione usare gunicorn (vedi gunicorn.conf.py)
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=False)
\ No newline at end of file
@@ -0,0 +1,20 @@
+# Configurazione gunicorn per la produzione
+# Avvio: gunicorn app:app  (legge automaticamente questo file)
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = f"{os.environ.get('FLASK_HOST', '0.0.0.0')}:{os.environ.get('FLASK_PORT', '5000')}"
+
+# Lo scraping è quasi tutto attesa di rete: pochi processi, molti thread
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+timeout = 30
+
+# Log su stdout/stderr, letti da systemd
+accesslog = "-"
+errorlog = "-"
@@ -0,0 +1,44 @@
+"""
+Conversione delle immagini per /image-proxy, eseguita nel pool di processi.
+
+Modulo separato da app.py di proposito: i processi del pool importano solo
+questo file (Pillow), non Flask, recipe_scrapers e la configurazione del servizio.
+"""
+from io import BytesIO
+
+from PIL import Image
+
+
+def transcode(data, max_size, optimize):
+    """Converte l'immagine in JPEG RGB, ridimensionata a max_size"""
+    img = Image.open(BytesIO(data))
+    
+    # Per i JPEG lascia che libjpeg decodifichi già in scala ridotta
+    # (1/2, 1/4, 1/8) invece di espandere tutti i pixel originali
+    img.draft('RGB', (max_size, max_size))
+    img.load()
+
+    # Converti in RGB se necessario (per gestire PNG con trasparenza o altri formati)
+    if img.mode == 'P':
+        img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+    if img.mode in ('RGBA', 'LA'):
+        alpha = img.getchannel('A')
+        if alpha.getextrema()[0] < 255:
+            # Trasparenza reale: componi su sfondo bianco
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=alpha)
+            img = background
+        else:
+            img = img.convert('RGB')
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    # Ridimensiona se troppo grande
+    if img.width > max_size or img.height > max_size:
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    
+    # Salva in JPEG (l'ottimizzazione Huffman raddoppia il tempo di encode
+    # per pochi punti percentuali di dimensione: solo su richiesta, ?optimize=1)
+    img_io = BytesIO()
+    img.save(img_io, 'JPEG', quality=85, optimize=optimize)
+    return img_io.getvalue()